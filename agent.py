@@ -1,79 +1,569 @@
+import asyncio
+import functools
+import io
 import json
 import os
+import re
+import threading
+import time
 
+import diskcache
+import httpx
+import orjson
 from dotenv import load_dotenv
+from google import genai
+from google.genai import errors, types
+from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langgraph.prebuilt import create_react_agent
+from langchain_google_genai.chat_models import ChatGoogleGenerativeAIError
 
-from prompts import SYSTEM_PROMPT, GRADING_PROMPT
-from tools import search_reference
+from bibliography import parse_json_from_text, search_bibliography
+from prompts import (
+    BATCH_GRADING_INSTRUCTIONS,
+    GRADING_CRITERIA_PROMPT,
+    GRADING_ESSAY_PROMPT,
+    GRADING_INSTRUCTIONS,
+    SYSTEM_PROMPT,
+)
+from tools import content_key, search_reference
 
 load_dotenv()
 
+MAX_OUTPUT_TOKENS = 8192
+_NUMBERED_LINE_RE = re.compile(r"^\s*\d+\.", re.MULTILINE)
 
-def create_grading_agent():
-    """Create and return the grading agent."""
-    llm = ChatGoogleGenerativeAI(
+GRADING_CACHE_DIR = "./.grading_cache"
+# Batch jobs may take up to a day, and a request referencing an expired
+# context cache fails, so the cache must outlive the job.
+BATCH_PREFIX_CACHE_TTL = "86400s"
+
+# Reference extraction failures the grader can recover from by searching
+# itself: an unparseable response, or Gemini erroring, over quota or timing out
+_EXTRACTION_ERRORS = (
+    json.JSONDecodeError,
+    ChatGoogleGenerativeAIError,
+    errors.APIError,
+    httpx.HTTPError,
+    TimeoutError,
+)
+
+BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return a long-lived event loop running in a background thread.
+
+    The async Gemini clients are shared and bound to the loop they are first
+    used on, so every synchronous entry point runs its coroutines here rather
+    than on a fresh asyncio.run loop.
+    """
+    global _event_loop
+    # Unlike lru_cache, the lock guarantees concurrent first callers (two
+    # Streamlit sessions starting at once) get the same loop
+    if _event_loop is None:
+        with _event_loop_lock:
+            if _event_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True).start()
+                _event_loop = loop
+    return _event_loop
+
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop()).result()
+
+
+def iter_async(agen):
+    """Drive an async generator on the shared event loop from synchronous code."""
+    loop = _get_event_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                break
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_grading_llm() -> ChatGoogleGenerativeAI:
+    """Return the shared Gemini client used by the grader."""
+    return ChatGoogleGenerativeAI(
         model="gemini-2.5-pro",
         google_api_key=os.getenv("GOOGLE_API_KEY"),
         temperature=0.1,
-        max_output_tokens=8192,
+        max_output_tokens=MAX_OUTPUT_TOKENS,
         timeout=120,
         model_kwargs={"thinking_config": {"thinking_budget": 0}},
     )
 
-    agent = create_react_agent(
-        model=llm,
-        tools=[search_reference],
-        prompt=SYSTEM_PROMPT,
+
+@functools.lru_cache(maxsize=1)
+def _get_grader_models():
+    """Return the grader's tool-calling and final-answer runnables.
+
+    Binding converts search_reference into a Gemini function declaration, so
+    both bindings are built once and reused across essays.
+    """
+    llm = _get_grading_llm()
+    return (
+        llm.bind_tools([search_reference]),
+        llm.bind_tools([search_reference], tool_choice="none"),
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _get_genai_client() -> genai.Client:
+    """Return the shared google.genai client used for batch jobs."""
+    return genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+
+
+@functools.lru_cache(maxsize=1)
+def _get_grading_cache() -> diskcache.Cache:
+    """Return the on-disk cache of grading results, keyed by input content."""
+    return diskcache.Cache(GRADING_CACHE_DIR)
+
+
+def _grading_cache_key(criteria_text: str, essay_text: str) -> str:
+    return content_key(criteria_text + "\x00" + essay_text)
+
+
+def _cache_grading_result(key: str, result: dict):
+    # Don't pin unparseable responses; the next run may well succeed
+    if not result.get("parse_error"):
+        _get_grading_cache()[key] = result
+
+
+def _format_reference_search_results(references: list[dict]) -> str:
+    """Render pre-computed reference searches for inclusion in the grading prompt."""
+    if not references:
+        return "No references were found in the essay."
+
+    lines = []
+    for i, ref in enumerate(references, 1):
+        lines.append(f"{i}. {ref['reference']}")
+        for item in ref.get("search_results", []):
+            lines.append(f"   - {item['title']} — {item['link']}")
+            if item["snippet"]:
+                lines.append(f"     {item['snippet']}")
+        lines.append(f"   Search notes: {ref.get('notes', '')}")
+    return "\n".join(lines)
+
+
+def _build_grading_prefix(criteria_text: str, can_search: bool = True) -> str:
+    """Build the part of the grading prompt shared by every essay on a rubric.
+
+    can_search says whether the grader has the search_reference tool.
+    """
+    instructions = GRADING_INSTRUCTIONS if can_search else BATCH_GRADING_INSTRUCTIONS
+    return instructions + "\n\n" + GRADING_CRITERIA_PROMPT.format(criteria_text=criteria_text)
+
+
+def _estimate_output_budget(criteria_text: str, num_refs: int | None) -> int:
+    """Estimate how many output tokens the grader's JSON response needs.
+
+    Scales with the number of criteria (numbered lines in the rubric) and
+    references. Falls back to the maximum when either count is unknown.
+
+    The cap only bounds runaway responses: tokens are billed as generated, so
+    a generous cap costs nothing extra, while a truncated response has to be
+    regraded from scratch. The allowances are therefore deliberately high,
+    enough for detailed feedback quoting the essay on every criterion.
+    """
+    num_criteria = len(_NUMBERED_LINE_RE.findall(criteria_text))
+    if not num_criteria or num_refs is None:
+        return MAX_OUTPUT_TOKENS
+    return min(MAX_OUTPUT_TOKENS, 1024 + 800 * num_criteria + 120 * num_refs)
+
+
+async def _build_essay_prompt(essay_text: str, can_search: bool = True) -> tuple[str, int | None]:
+    """Build the per-essay part of the grading prompt.
+
+    can_search says whether the grader has the search_reference tool to fall
+    back on if reference extraction fails.
+
+    Returns:
+        The prompt and the number of references found, or None if reference
+        extraction failed.
+    """
+    # Search all references up front (in parallel) so the grader can judge them
+    # in its own response rather than making one tool round-trip per reference.
+    try:
+        references = await search_bibliography(essay_text)
+    except _EXTRACTION_ERRORS:
+        num_refs = None
+        if can_search:
+            reference_search_results = (
+                "Automatic reference extraction failed. Use the search_reference tool "
+                "to verify each reference the essay cites."
+            )
+        else:
+            reference_search_results = (
+                "Automatic reference extraction failed, so no references could be "
+                "searched. List each reference the essay cites with \"verified\" set "
+                "to false and a note that it could not be checked."
+            )
+    else:
+        num_refs = len(references)
+        reference_search_results = _format_reference_search_results(references)
+
+    prompt = GRADING_ESSAY_PROMPT.format(
+        essay_text=essay_text,
+        reference_search_results=reference_search_results,
     )
+    return prompt, num_refs
+
+
+async def _build_grading_prompt(criteria_text: str, essay_text: str) -> tuple[str, int]:
+    """Build the grading prompt, including pre-computed reference searches.
 
-    return agent
+    Returns:
+        The prompt and the output token budget for grading it.
+    """
+    essay_prompt, num_refs = await _build_essay_prompt(essay_text)
+    prompt = _build_grading_prefix(criteria_text) + "\n" + essay_prompt
+    return prompt, _estimate_output_budget(criteria_text, num_refs)
 
 
-def grade_essay(criteria_text: str, essay_text: str) -> dict:
+def parse_grading_response(final_message: str) -> dict:
+    """Parse the grader's JSON response, falling back to the raw text.
+
+    Args:
+        final_message: The grader's final response text.
+
+    Returns:
+        The parsed grading results, or a dict with 'raw_response' and
+        'parse_error' if the response is not valid JSON.
+    """
+    try:
+        return parse_json_from_text(final_message)
+    except json.JSONDecodeError:
+        # Return raw text if JSON parsing fails
+        return {
+            "raw_response": final_message,
+            "parse_error": True,
+        }
+
+
+def _content_text(content) -> str:
+    """Return the text of a (possibly multi-part) Gemini message chunk."""
+    if isinstance(content, list):
+        return "".join(
+            part if isinstance(part, str) else part.get("text", "")
+            for part in content
+        )
+    return content
+
+
+# Sentinels yielded by _stream_grader: between the tool-calling turn and the
+# answer, and after an answer cut off by the output token limit
+_DISCARD_TEXT = object()
+_TRUNCATED = object()
+
+
+async def _stream_grader(prompt: str, max_output_tokens: int = MAX_OUTPUT_TOKENS):
+    """Run the grader on a prompt, yielding its response text as it arrives.
+
+    Rather than a ReAct loop with one LLM round-trip per tool call, the grader
+    gets one turn to request all the searches it needs. They run in parallel,
+    and one follow-up call (with tool use disabled) produces the final answer,
+    so grading takes at most two LLM calls.
+
+    Any text from the tool-calling turn is streamed too, followed by
+    _DISCARD_TEXT: only the text after that marker is the graded response.
+    If that response hit max_output_tokens, _TRUNCATED is yielded last.
+    """
+    tool_model, answer_model = _get_grader_models()
+    messages = [SystemMessage(content=SYSTEM_PROMPT), HumanMessage(content=prompt)]
+    generation_config = {"max_output_tokens": max_output_tokens}
+
+    response = None
+    finish_reason = None
+    async for chunk in tool_model.astream(messages, generation_config=generation_config):
+        response = chunk if response is None else response + chunk
+        finish_reason = chunk.response_metadata.get("finish_reason", finish_reason)
+        if text := _content_text(chunk.content):
+            yield text
+
+    if response is not None and response.tool_calls:
+        yield _DISCARD_TEXT
+
+        # Sync tools run in the event loop's default thread pool, so these overlap
+        tool_messages = await asyncio.gather(
+            *(search_reference.ainvoke(call) for call in response.tool_calls)
+        )
+        messages += [response, *tool_messages]
+
+        finish_reason = None
+        async for chunk in answer_model.astream(messages, generation_config=generation_config):
+            finish_reason = chunk.response_metadata.get("finish_reason", finish_reason)
+            if text := _content_text(chunk.content):
+                yield text
+
+    if finish_reason == "MAX_TOKENS":
+        yield _TRUNCATED
+
+
+def grade_essay(criteria_text: str, essay_text: str, force: bool = False) -> dict:
     """Grade an essay against the provided criteria.
 
+    Results are cached on disk, so regrading an identical essay against
+    identical criteria returns immediately.
+
     Args:
         criteria_text: The grading criteria text.
         essay_text: The student's essay text.
+        force: Regrade even if a cached result exists.
 
     Returns:
         A dictionary with grading results.
     """
-    agent = create_grading_agent()
+    *_, result = iter_async(grade_essay_stream(criteria_text, essay_text, force))
+    return result
 
-    prompt = GRADING_PROMPT.format(
-        criteria_text=criteria_text,
-        essay_text=essay_text,
-    )
 
-    result = agent.invoke(
-        {"messages": [("user", prompt)]},
-        config={"recursion_limit": 30},
-    )
+async def grade_essay_stream(criteria_text: str, essay_text: str, force: bool = False):
+    """Grade an essay, yielding the grader's output as it is generated.
 
-    # Extract the final AI message content
-    final_message = result["messages"][-1].content
-    # Gemini may return content as a list of parts — extract text parts
-    if isinstance(final_message, list):
-        final_message = "\n".join(
-            part if isinstance(part, str) else part.get("text", "")
-            for part in final_message
+    The text is for display only: if the grader called tools, it includes
+    whatever it wrote before doing so. The parsed result, from the final
+    answer alone, is yielded last. A cached result is yielded as a single
+    chunk of JSON, followed by the result itself.
+
+    Args:
+        criteria_text: The grading criteria text.
+        essay_text: The student's essay text.
+        force: Regrade even if a cached result exists.
+
+    Yields:
+        Text chunks of the grader's output, then the grading result dict.
+    """
+    key = _grading_cache_key(criteria_text, essay_text)
+    if not force and (cached := _get_grading_cache().get(key)) is not None:
+        yield orjson.dumps(cached).decode("utf-8")
+        yield cached
+        return
+
+    prompt, max_output_tokens = await _build_grading_prompt(criteria_text, essay_text)
+
+    # The estimated budget can fall short; a truncated response is retried
+    # once with the maximum budget
+    budgets = [max_output_tokens]
+    if max_output_tokens < MAX_OUTPUT_TOKENS:
+        budgets.append(MAX_OUTPUT_TOKENS)
+
+    for budget in budgets:
+        chunks = []
+        truncated = False
+        async for chunk in _stream_grader(prompt, budget):
+            if chunk is _TRUNCATED:
+                truncated = True
+                continue
+            if chunk is _DISCARD_TEXT:
+                if chunks:
+                    yield "\n\n"
+                chunks = []
+                continue
+            chunks.append(chunk)
+            yield chunk
+        if not truncated or budget == budgets[-1]:
+            break
+        yield "\n\n*The response was cut off; regrading with a larger output budget.*\n\n"
+
+    result = parse_grading_response("".join(chunks))
+    _cache_grading_result(key, result)
+    yield result
+
+
+async def _create_prefix_cache(client: genai.Client, criteria_text: str) -> str | None:
+    """Create a Gemini context cache holding the batch grading prompt prefix.
+
+    Returns:
+        The cache name, or None if Gemini rejects the cache (explicit caching
+        has a minimum size, which short rubrics do not reach).
+    """
+    try:
+        cache = await client.aio.caches.create(
+            model="gemini-2.5-pro",
+            config=types.CreateCachedContentConfig(
+                display_name="grading-prefix",
+                system_instruction=SYSTEM_PROMPT,
+                contents=[types.Content(
+                    role="user",
+                    parts=[types.Part(text=_build_grading_prefix(criteria_text, can_search=False))],
+                )],
+                ttl=BATCH_PREFIX_CACHE_TTL,
+            ),
         )
+    except errors.APIError:
+        return None
+    return cache.name
+
+
+async def submit_grading_batch(pairs: list[tuple[str, str]]) -> dict:
+    """Submit several essays to the Gemini Batch API for asynchronous grading.
+
+    Batch jobs are billed at half the interactive rate but may take minutes to
+    hours to complete. The grader has no tool access in batch mode, so it relies
+    entirely on the pre-computed reference searches in the prompt. When every
+    essay shares the same criteria, the common prompt prefix is placed in a
+    context cache so its tokens are billed at the cached rate.
+
+    Args:
+        pairs: List of (criteria_text, essay_text) tuples.
+
+    Returns:
+        The batch job: a dict with its 'name', 'num_essays' and the name of
+        its prefix cache ('cached_content', or None), to be passed to
+        get_grading_batch_results.
+    """
+    client = _get_genai_client()
+
+    essay_prompts = await asyncio.gather(
+        *(_build_essay_prompt(essay_text, can_search=False) for _, essay_text in pairs)
+    )
+
+    # With a shared rubric, the system prompt, instructions and criteria are an
+    # identical prefix for every essay: cache them once and reference the cache.
+    # It is created only now, so that nothing can fail between creating it and
+    # handing it to a job, except the submission itself.
+    cached_content = None
+    if len(pairs) > 1 and len({criteria_text for criteria_text, _ in pairs}) == 1:
+        cached_content = await _create_prefix_cache(client, pairs[0][0])
 
-    # Try to parse JSON from the response
     try:
-        # The model might wrap JSON in markdown code blocks
-        text = final_message
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0]
-        elif "```" in text:
-            text = text.split("```")[1].split("```")[0]
-        return json.loads(text.strip())
-    except (json.JSONDecodeError, IndexError):
-        # Return raw text if JSON parsing fails
+        lines = []
+        for i, ((criteria_text, _), (essay_prompt, num_refs)) in enumerate(zip(pairs, essay_prompts)):
+            request = {
+                "generation_config": {
+                    "temperature": 0.1,
+                    "max_output_tokens": _estimate_output_budget(criteria_text, num_refs),
+                    "thinking_config": {"thinking_budget": 0},
+                },
+            }
+            if cached_content:
+                request["cached_content"] = cached_content
+                request["contents"] = [{"role": "user", "parts": [{"text": essay_prompt}]}]
+            else:
+                prompt = _build_grading_prefix(criteria_text, can_search=False) + "\n" + essay_prompt
+                request["system_instruction"] = {"parts": [{"text": SYSTEM_PROMPT}]}
+                request["contents"] = [{"role": "user", "parts": [{"text": prompt}]}]
+            lines.append(json.dumps({"key": f"essay-{i}", "request": request}))
+
+        uploaded = await client.aio.files.upload(
+            file=io.BytesIO("\n".join(lines).encode("utf-8")),
+            config=types.UploadFileConfig(display_name="grading-batch", mime_type="jsonl"),
+        )
+        job = await client.aio.batches.create(
+            model="gemini-2.5-pro",
+            src=uploaded.name,
+            config={"display_name": "grading-batch"},
+        )
+    except BaseException:
+        # No job will ever reference the cache, so don't leave it to expire
+        if cached_content:
+            try:
+                await client.aio.caches.delete(name=cached_content)
+            except errors.APIError:
+                pass  # report the submission failure, not this one
+        raise
+    return {"name": job.name, "num_essays": len(pairs), "cached_content": cached_content}
+
+
+def _parse_batch_response(item: dict) -> dict:
+    """Parse one line of a batch job's output into a grading result."""
+    if "response" not in item:
         return {
-            "raw_response": final_message,
+            "raw_response": json.dumps(item.get("error", item)),
             "parse_error": True,
         }
+
+    # A blocked prompt has no candidates; a blocked answer has no content
+    response = item["response"]
+    candidates = response.get("candidates") or [{}]
+    if "content" not in candidates[0]:
+        reason = (
+            response.get("promptFeedback", {}).get("blockReason")
+            or candidates[0].get("finishReason")
+            or "no content"
+        )
+        return {
+            "raw_response": f"Gemini returned no response ({reason}).",
+            "parse_error": True,
+        }
+
+    parts = candidates[0]["content"].get("parts", [])
+    return parse_grading_response("\n".join(part.get("text", "") for part in parts))
+
+
+def get_grading_batch_results(job: dict) -> list[dict] | None:
+    """Fetch the results of a batch submitted with submit_grading_batch.
+
+    Once the job has finished, its prefix cache is deleted (and removed from
+    the job dict) rather than left to expire.
+
+    Args:
+        job: The batch job returned by submit_grading_batch.
+
+    Returns:
+        None while the job is still running, otherwise a list of grading result
+        dicts in the order the essays were submitted. Essays missing from the
+        output are marked with 'parse_error'.
+
+    Raises:
+        RuntimeError: If the batch job failed, was cancelled, or expired.
+    """
+    client = _get_genai_client()
+    batch = client.batches.get(name=job["name"])
+    state = batch.state.name
+    if state not in BATCH_DONE_STATES:
+        return None
+
+    if cached_content := job.pop("cached_content", None):
+        try:
+            client.caches.delete(name=cached_content)
+        except errors.APIError:
+            pass  # already expired or deleted; it would lapse at its TTL anyway
+
+    if state != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Batch job {job['name']} ended with state {state}")
+
+    content = client.files.download(file=batch.dest.file_name).decode("utf-8")
+    results = {}
+    for line in content.splitlines():
+        if line.strip():
+            item = orjson.loads(line)
+            results[item["key"]] = _parse_batch_response(item)
+
+    return [
+        results.get(f"essay-{i}")
+        or {"raw_response": "Missing from the batch output.", "parse_error": True}
+        for i in range(job["num_essays"])
+    ]
+
+
+def grade_essays_batch(pairs: list[tuple[str, str]], poll_interval: int = 30) -> list[dict]:
+    """Grade several essays through the Batch API, blocking until done.
+
+    Args:
+        pairs: List of (criteria_text, essay_text) tuples.
+        poll_interval: Seconds to wait between status checks.
+
+    Returns:
+        A list of grading result dicts, one per essay, in input order.
+    """
+    job = run_async(submit_grading_batch(pairs))
+    while (results := get_grading_batch_results(job)) is None:
+        time.sleep(poll_interval)
+    return results
@@ -1,7 +1,71 @@
 import time
 import streamlit as st
 from tools import extract_text_from_file
-from agent import grade_essay
+from agent import (
+    get_grading_batch_results,
+    grade_essay_stream,
+    iter_async,
+    run_async,
+    submit_grading_batch,
+)
+
+
+def render_result(result: dict):
+    """Render a single grading result."""
+    if result.get("parse_error"):
+        st.warning("The agent returned a non-structured response. Showing raw output:")
+        st.markdown(result.get("raw_response", "No response"))
+        return
+
+    # Overall score
+    total = result.get("total_score", "N/A")
+    max_total = result.get("max_total_score", "N/A")
+    st.header(f"Overall Score: {total} / {max_total}")
+
+    # Overall feedback
+    st.markdown("### Overall Feedback")
+    st.info(result.get("overall_feedback", ""))
+
+    # Priority improvements
+    improvements = result.get("priority_improvements", [])
+    if improvements:
+        st.markdown("### Top Priority Improvements")
+        for i, imp in enumerate(improvements, 1):
+            st.markdown(f"**{i}.** {imp}")
+
+    st.divider()
+
+    # Per-criterion results
+    st.markdown("## Criterion-by-Criterion Feedback")
+    for item in result.get("criteria_results", []):
+        name = item.get("criterion_name", "Unknown Criterion")
+        score = item.get("score", "?")
+        max_score = item.get("max_score", "?")
+
+        with st.expander(f"{name} — {score}/{max_score}", expanded=True):
+            st.markdown("**Feedback:**")
+            st.markdown(item.get("feedback", ""))
+            suggestions = item.get("suggestions", "")
+            if suggestions:
+                st.markdown("**Suggestions for improvement:**")
+                st.markdown(suggestions)
+
+    st.divider()
+
+    # Bibliography verification
+    bib = result.get("bibliography", [])
+    if bib:
+        st.markdown("## Bibliography Verification")
+        for ref in bib:
+            verified = ref.get("verified", False)
+            icon = "✅" if verified else "❌"
+            with st.expander(f"{icon} {ref.get('reference', 'Unknown reference')[:100]}"):
+                st.markdown(f"**Verified:** {'Yes' if verified else 'No'}")
+                st.markdown(f"**Notes:** {ref.get('notes', 'No details')}")
+    else:
+        st.markdown("## Bibliography")
+        st.warning("No bibliography references were found or extracted from the essay.")
+
 
 st.set_page_config(page_title="Essay Grading Agent", layout="wide")
 
@@ -35,14 +99,63 @@ with col1:
 
 with col2:
     st.subheader("Student Essay")
-    essay_file = st.file_uploader(
-        "Upload student essay (PDF)",
-        type=["pdf", "txt"],
-        key="essay",
+    batch_mode = st.toggle(
+        "Batch mode",
+        help="Grade several essays through the Gemini Batch API at half the cost. "
+        "Results can take a while; check back on the job later.",
+    )
+    if batch_mode:
+        essay_files = st.file_uploader(
+            "Upload student essays (PDF)",
+            type=["pdf", "txt"],
+            accept_multiple_files=True,
+            key="essays",
+        )
+        essay_file = None
+    else:
+        essay_file = st.file_uploader(
+            "Upload student essay (PDF)",
+            type=["pdf", "txt"],
+            key="essay",
+        )
+        essay_files = []
+    force_regrade = st.checkbox(
+        "Force regrade",
+        help="Ignore any cached result for this exact essay and criteria.",
+        disabled=batch_mode,
     )
 
 has_criteria = (criteria_text_input and criteria_text_input.strip()) or criteria_file
-if has_criteria and essay_file:
+if has_criteria and batch_mode and essay_files:
+    if st.button("Submit Batch", type="primary", use_container_width=True):
+        with st.spinner("Extracting essays and searching references before submitting the batch..."):
+            if criteria_text_input and criteria_text_input.strip():
+                criteria_text = criteria_text_input.strip()
+            else:
+                criteria_text = extract_text_from_file(criteria_file)
+            if not criteria_text.strip():
+                st.error("Could not extract text from the criteria. Please check your input.")
+                st.stop()
+
+            pairs = []
+            names = []
+            for f in essay_files:
+                essay_text = extract_text_from_file(f)
+                if not essay_text.strip():
+                    st.warning(f"Could not extract text from {f.name}; skipping it.")
+                    continue
+                pairs.append((criteria_text, essay_text))
+                names.append(f.name)
+
+            if not pairs:
+                st.error("None of the essay files contained extractable text.")
+                st.stop()
+
+            st.session_state["batch_job"] = {
+                **run_async(submit_grading_batch(pairs)),
+                "essays": names,
+            }
+elif has_criteria and essay_file:
     if st.button("Grade Essay", type="primary", use_container_width=True):
         with st.spinner("Grading in progress — the agent is reading, evaluating, and verifying bibliography. This may take a few minutes..."):
             start_time = time.time()
@@ -60,7 +173,19 @@ if has_criteria and essay_file:
                 st.error("Could not extract text from the essay file. Please check the file.")
                 st.stop()
 
-            result = grade_essay(criteria_text, essay_text)
+            # The stream ends with the parsed result; only the text is displayed
+            results = []
+
+            def grader_text():
+                for item in iter_async(grade_essay_stream(criteria_text, essay_text, force=force_regrade)):
+                    if isinstance(item, dict):
+                        results.append(item)
+                    else:
+                        yield item
+
+            with st.expander("Live grader output", expanded=True):
+                st.write_stream(grader_text())
+            result = results[-1]
             elapsed = time.time() - start_time
 
         minutes, seconds = divmod(int(elapsed), 60)
@@ -69,60 +194,25 @@ if has_criteria and essay_file:
         else:
             st.caption(f"Grading completed in {seconds}s")
 
-        if result.get("parse_error"):
-            st.warning("The agent returned a non-structured response. Showing raw output:")
-            st.markdown(result.get("raw_response", "No response"))
+        render_result(result)
+elif "batch_job" not in st.session_state:
+    st.info("Please provide grading criteria (paste or upload) and upload a student essay to begin.")
+
+if batch_mode and "batch_job" in st.session_state:
+    job = st.session_state["batch_job"]
+    st.divider()
+    st.markdown(f"## Batch Job `{job['name']}`")
+    st.caption(f"{len(job['essays'])} essay(s) submitted.")
+    if st.button("Check batch status", use_container_width=True):
+        try:
+            results = get_grading_batch_results(job)
+        except RuntimeError as e:
+            st.error(str(e))
             st.stop()
 
-        # --- Display results ---
-
-        # Overall score
-        total = result.get("total_score", "N/A")
-        max_total = result.get("max_total_score", "N/A")
-        st.header(f"Overall Score: {total} / {max_total}")
-
-        # Overall feedback
-        st.markdown("### Overall Feedback")
-        st.info(result.get("overall_feedback", ""))
-
-        # Priority improvements
-        improvements = result.get("priority_improvements", [])
-        if improvements:
-            st.markdown("### Top Priority Improvements")
-            for i, imp in enumerate(improvements, 1):
-                st.markdown(f"**{i}.** {imp}")
-
-        st.divider()
-
-        # Per-criterion results
-        st.markdown("## Criterion-by-Criterion Feedback")
-        for item in result.get("criteria_results", []):
-            name = item.get("criterion_name", "Unknown Criterion")
-            score = item.get("score", "?")
-            max_score = item.get("max_score", "?")
-
-            with st.expander(f"{name} — {score}/{max_score}", expanded=True):
-                st.markdown("**Feedback:**")
-                st.markdown(item.get("feedback", ""))
-                suggestions = item.get("suggestions", "")
-                if suggestions:
-                    st.markdown("**Suggestions for improvement:**")
-                    st.markdown(suggestions)
-
-        st.divider()
-
-        # Bibliography verification
-        bib = result.get("bibliography", [])
-        if bib:
-            st.markdown("## Bibliography Verification")
-            for ref in bib:
-                verified = ref.get("verified", False)
-                icon = "✅" if verified else "❌"
-                with st.expander(f"{icon} {ref.get('reference', 'Unknown reference')[:100]}"):
-                    st.markdown(f"**Verified:** {'Yes' if verified else 'No'}")
-                    st.markdown(f"**Notes:** {ref.get('notes', 'No details')}")
+        if results is None:
+            st.info("The batch is still running. Check again in a few minutes.")
         else:
-            st.markdown("## Bibliography")
-            st.warning("No bibliography references were found or extracted from the essay.")
-else:
-    st.info("Please provide grading criteria (paste or upload) and upload a student essay to begin.")
+            for tab, result in zip(st.tabs(job["essays"]), results):
+                with tab:
+                    render_result(result)
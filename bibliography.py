@@ -7,89 +7,164 @@ Usage:
     python bibliography.py --essay path/to/essay.pdf
 """
 
+import asyncio
+import functools
 import json
 import os
-import time
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import re
 
+import httpx
+import orjson
 from dotenv import load_dotenv
-from googlesearch import search
 from langchain_google_genai import ChatGoogleGenerativeAI
 
+from tools import (
+    SEARCH_CONCURRENCY,
+    SingleFlight,
+    content_key,
+    describe_search_error,
+    google_search,
+    normalize_reference,
+)
+
 load_dotenv()
 
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+_BIBLIOGRAPHY_HEADING_RE = re.compile(r"\n\s*(references|bibliography|works cited)\s*\n", re.IGNORECASE)
+# An APA entry starts a line with "Surname, I." and contains "(YYYY)."
+_APA_ENTRY_START_RE = re.compile(r"^[A-Z][\w'’-]+,\s+[A-Z]\.", re.MULTILINE)
+_APA_YEAR_RE = re.compile(r"\(\d{4}[a-z]?\)\.")
+
+BIBLIOGRAPHY_MIN_CHARS = 200
+APA_ENTRY_MAX_CHARS = 600
+
+# Gemini JSON schema for extract_references_with_llm's response
+REFERENCES_SCHEMA = {"type": "array", "items": {"type": "string"}}
+
+# Identical prompts to the same client (e.g. the same essay graded by two users
+# at once) share one call; only responses that parse are kept
+_llm_flight = SingleFlight(maxsize=256, ttl=3600)
 
-def _invoke_llm(prompt: str) -> str:
-    """Invoke Gemini and return the response as a plain string."""
-    llm = ChatGoogleGenerativeAI(
+
+def _make_llm(**kwargs) -> ChatGoogleGenerativeAI:
+    return ChatGoogleGenerativeAI(
         model="gemini-2.5-pro",
         google_api_key=os.getenv("GOOGLE_API_KEY"),
         temperature=0,
         max_output_tokens=4096,
+        response_mime_type="application/json",
         model_kwargs={"thinking_config": {"thinking_budget": 0}},
+        **kwargs,
     )
-    response = llm.invoke(prompt)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_llm() -> ChatGoogleGenerativeAI:
+    """Return the shared Gemini client used for verification."""
+    return _make_llm()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_extraction_llm() -> ChatGoogleGenerativeAI:
+    """Return the shared Gemini client used for extraction, constrained to REFERENCES_SCHEMA."""
+    return _make_llm(response_schema=REFERENCES_SCHEMA)
+
+
+async def _invoke_llm_json(prompt: str, llm: ChatGoogleGenerativeAI = None):
+    """Invoke Gemini (the verification client by default) and parse its JSON response.
+
+    Raises:
+        json.JSONDecodeError: If the response is not valid JSON. Such responses
+            are not cached, so the next call asks Gemini again.
+    """
+    llm = llm or _get_llm()
+    # The same prompt means something different to a client with a schema
+    key = content_key(f"{llm.model}\x00{json.dumps(llm.response_schema)}\x00{prompt}")
+    return await _llm_flight.ado(key, _invoke_llm_json_uncached, prompt, llm)
+
+
+async def _invoke_llm_json_uncached(prompt: str, llm: ChatGoogleGenerativeAI):
+    response = await llm.ainvoke(prompt)
     content = response.content
     if isinstance(content, list):
         content = "\n".join(
             part if isinstance(part, str) else part.get("text", "")
             for part in content
         )
-    return content
+    return parse_json_from_text(content)
+
 
+def parse_json_from_text(text: str):
+    """Extract and parse JSON from LLM response text.
 
-def _parse_json_from_text(text: str):
-    """Extract and parse JSON from LLM response text."""
-    text = text.strip()
-    if "```json" in text:
-        text = text.split("```json")[1].split("```")[0]
-    elif "```" in text:
-        text = text.split("```")[1].split("```")[0]
-    return json.loads(text.strip())
+    Handles both bare JSON and JSON wrapped in a markdown code fence.
+    """
+    match = _FENCE_RE.search(text)
+    return orjson.loads(match.group(1) if match else text)
 
 
-def search_single_reference(reference: str) -> dict:
+async def search_single_reference(reference: str) -> dict:
     """Search Google to verify a single bibliographic reference.
 
     Args:
         reference: The full reference string.
 
     Returns:
-        Dict with keys: reference, verified, search_urls, notes.
+        Dict with keys: reference, verified, search_urls, search_results, notes.
+        Each entry of search_results has 'title', 'link' and 'snippet'.
     """
     result = {
         "reference": reference,
         "verified": False,
         "search_urls": [],
+        "search_results": [],
         "notes": "",
     }
 
     try:
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(
-                lambda: list(search(reference, num_results=3, lang="en"))
-            )
-            try:
-                urls = future.result(timeout=10)
-            except TimeoutError:
-                result["notes"] = "Search timed out."
-                return result
-        time.sleep(0.5)
-
-        result["search_urls"] = urls
-
-        if not urls:
+        try:
+            # google_search limits concurrency and enforces its own deadline,
+            # which only starts once the search does
+            items = await asyncio.to_thread(google_search, reference)
+        except (TimeoutError, httpx.TimeoutException):
+            result["notes"] = "Search timed out."
+            return result
+
+        result["search_results"] = items
+        result["search_urls"] = [item["link"] for item in items]
+
+        if not items:
             result["notes"] = "No search results found. Reference may not exist."
         else:
-            result["notes"] = f"Found {len(urls)} search results."
+            result["notes"] = f"Found {len(items)} search results."
         return result
 
     except Exception as e:
-        result["notes"] = f"Search failed: {str(e)}"
+        result["notes"] = f"Search failed: {describe_search_error(e)}"
         return result
 
 
-def extract_references_with_llm(essay_text: str) -> list[str]:
+async def search_references(references: list[str]) -> list[dict]:
+    """Search Google for several references concurrently.
+
+    Args:
+        references: List of reference strings.
+
+    Returns:
+        List of dicts from search_single_reference, in the same order as the input.
+    """
+    # Searches are limited globally inside google_search; this just keeps one
+    # bibliography from filling the default thread pool with waiting searches
+    semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+
+    async def search_one(reference: str) -> dict:
+        async with semaphore:
+            return await search_single_reference(reference)
+
+    return list(await asyncio.gather(*(search_one(ref) for ref in references)))
+
+
+async def extract_references_with_llm(essay_text: str) -> list[str]:
     """Use Gemini to extract bibliographic references from essay text.
 
     Args:
@@ -97,27 +172,89 @@ def extract_references_with_llm(essay_text: str) -> list[str]:
 
     Returns:
         List of reference strings.
+
+    Raises:
+        json.JSONDecodeError: If the response is not valid JSON, e.g. because
+            it was truncated. The response schema otherwise guarantees an
+            array of strings.
     """
     prompt = (
-        "Extract ALL bibliographic references from the following essay text. "
-        "Return ONLY a JSON array of strings, where each string is one full reference "
-        "exactly as it appears in the essay. If there are no references, return an empty array [].\n\n"
+        "Extract ALL bibliographic references from the following essay text, "
+        "each one full reference exactly as it appears in the essay. "
+        "If there are no references, return an empty array.\n\n"
         f"Essay text:\n{essay_text}"
     )
 
-    content = _invoke_llm(prompt)
+    # Copied, as the parsed response is shared with later identical calls
+    return list(await _invoke_llm_json(prompt, _get_extraction_llm()))
 
-    try:
-        refs = _parse_json_from_text(content)
-        if isinstance(refs, list):
-            return [str(r) for r in refs]
-    except (json.JSONDecodeError, IndexError):
+
+def _slice_bibliography_section(text: str) -> str | None:
+    """Return the text after the last References/Bibliography/Works Cited heading.
+
+    Returns None if there is no such heading, or if what follows it is too
+    short to plausibly be the bibliography.
+    """
+    match = None
+    for match in _BIBLIOGRAPHY_HEADING_RE.finditer(text):
         pass
+    if match is None:
+        return None
+
+    section = text[match.end():]
+    if len(section) <= BIBLIOGRAPHY_MIN_CHARS:
+        return None
+    return section
 
-    return []
 
+def _extract_references_with_regex(section: str) -> list[str] | None:
+    """Split a bibliography section into APA-style entries without an LLM.
 
-def verify_references_with_llm(references: list[dict]) -> list[dict]:
+    Only succeeds when the whole section parses cleanly: it starts with an
+    entry, and every entry has exactly one APA year and a plausible length.
+    Anything else (MLA, numbered styles, trailing appendices, entries whose
+    start the regex misses, such as organisations or "van Dijk, T.") returns
+    None.
+    """
+    starts = [m.start() for m in _APA_ENTRY_START_RE.finditer(section)]
+    if not starts or section[:starts[0]].strip():
+        return None
+
+    refs = []
+    for start, end in zip(starts, starts[1:] + [len(section)]):
+        # PDF extraction wraps entries across lines; rejoin them
+        entry = " ".join(section[start:end].split())
+        # A second year means the next entry's start was not recognised
+        if len(entry) > APA_ENTRY_MAX_CHARS or len(_APA_YEAR_RE.findall(entry)) != 1:
+            return None
+        refs.append(entry)
+    return refs
+
+
+async def extract_references(essay_text: str) -> list[str]:
+    """Extract bibliographic references, using Gemini only when necessary.
+
+    If the essay has a recognisable bibliography section, only that section is
+    considered; if it is cleanly APA-formatted, it is split by regex and Gemini
+    is not called at all.
+
+    Args:
+        essay_text: The full essay text.
+
+    Returns:
+        List of reference strings.
+    """
+    section = _slice_bibliography_section(essay_text)
+    if section is None:
+        return await extract_references_with_llm(essay_text)
+
+    refs = _extract_references_with_regex(section)
+    if refs is not None:
+        return refs
+    return await extract_references_with_llm(section)
+
+
+async def verify_references_with_llm(references: list[dict]) -> list[dict]:
     """Use Gemini to assess whether search results confirm each reference.
 
     Args:
@@ -126,33 +263,31 @@ def verify_references_with_llm(references: list[dict]) -> list[dict]:
     Returns:
         Updated list with 'verified' and 'notes' set by LLM assessment.
     """
-    refs_with_urls = [r for r in references if r.get("search_urls")]
-    if not refs_with_urls:
+    refs_with_results = [r for r in references if r.get("search_results")]
+    if not refs_with_results:
         return references
 
     ref_details = []
     for r in references:
         ref_details.append({
             "reference": r["reference"],
-            "search_urls": r.get("search_urls", []),
+            "search_results": r.get("search_results", []),
             "search_notes": r.get("notes", ""),
         })
 
     prompt = (
         "You are verifying bibliographic references. For each reference below, "
-        "I provide the Google search result URLs. Assess whether the reference "
+        "I provide the top Google search results (title, URL and snippet). Assess whether the reference "
         "is likely REAL and correctly cited (correct authors, year, title, journal/publisher). "
-        "Be skeptical — if the URLs don't clearly confirm the reference, mark it unverified.\n\n"
+        "Be skeptical — if the results don't clearly confirm the reference, mark it unverified.\n\n"
         f"References:\n{json.dumps(ref_details, indent=2)}\n\n"
         "Respond with a JSON array where each element has:\n"
         '  {"reference": "...", "verified": true/false, "notes": "explanation"}\n'
         "Return ONLY the JSON array."
     )
 
-    content = _invoke_llm(prompt)
-
     try:
-        llm_results = _parse_json_from_text(content)
+        llm_results = await _invoke_llm_json(prompt)
         if isinstance(llm_results, list):
             llm_map = {r["reference"]: r for r in llm_results}
             for ref in references:
@@ -160,35 +295,72 @@ def verify_references_with_llm(references: list[dict]) -> list[dict]:
                     llm_ref = llm_map[ref["reference"]]
                     ref["verified"] = llm_ref.get("verified", False)
                     ref["notes"] = llm_ref.get("notes", ref["notes"])
-    except (json.JSONDecodeError, IndexError):
+    except json.JSONDecodeError:
         for ref in references:
             ref["notes"] += " (LLM verification failed to parse)"
 
     return references
 
 
-def verify_bibliography(essay_text: str) -> list[dict]:
+def _dedupe_references(references: list[str]) -> dict[str, str]:
+    """Map each normalized reference to its first occurrence, in order."""
+    unique = {}
+    for ref in references:
+        unique.setdefault(normalize_reference(ref), ref)
+    return unique
+
+
+async def search_bibliography(essay_text: str) -> list[dict]:
+    """Extract references from essay and search them, without LLM verification.
+
+    Used by the grading agent, which judges the search results itself as part
+    of the grading call instead of paying for a separate verification call.
+    References that differ only in case, whitespace or trailing punctuation are
+    searched once and reported once.
+
+    Args:
+        essay_text: The full essay text.
+
+    Returns:
+        List of dicts from search_single_reference ('verified' is always False).
+    """
+    ref_strings = await extract_references(essay_text)
+    if not ref_strings:
+        return []
+
+    return await search_references(list(_dedupe_references(ref_strings).values()))
+
+
+async def verify_bibliography(essay_text: str) -> list[dict]:
     """Full pipeline: extract references from essay, search, and verify.
 
+    Duplicate references are searched and verified once; every occurrence gets
+    the same result.
+
     Args:
         essay_text: The full essay text.
 
     Returns:
         List of dicts with: reference, verified, search_urls, notes.
     """
-    ref_strings = extract_references_with_llm(essay_text)
+    ref_strings = await extract_references(essay_text)
     if not ref_strings:
         return []
 
-    search_results = [search_single_reference(ref) for ref in ref_strings]
-    verified_results = verify_references_with_llm(search_results)
+    unique = _dedupe_references(ref_strings)
+    search_results = await search_references(list(unique.values()))
+    verified_results = await verify_references_with_llm(search_results)
 
-    return verified_results
+    by_key = dict(zip(unique, verified_results))
+    return [
+        {**by_key[normalize_reference(ref)], "reference": ref}
+        for ref in ref_strings
+    ]
 
 
 if __name__ == "__main__":
     import sys
-    from pypdf import PdfReader
+    from tools import extract_pdf_text
 
     if len(sys.argv) < 2:
         print("Usage:")
@@ -198,13 +370,12 @@ if __name__ == "__main__":
 
     if sys.argv[1] == "--essay":
         pdf_path = sys.argv[2]
-        reader = PdfReader(pdf_path)
-        text = "\n\n".join(p.extract_text() or "" for p in reader.pages)
+        text = extract_pdf_text(pdf_path)
 
         print(f"Extracted {len(text)} characters from {pdf_path}")
         print("Running full bibliography verification pipeline...\n")
 
-        results = verify_bibliography(text)
+        results = asyncio.run(verify_bibliography(text))
 
         if not results:
             print("No references found in the essay.")
@@ -217,5 +388,5 @@ if __name__ == "__main__":
     else:
         ref = " ".join(sys.argv[1:])
         print(f"Searching for: {ref}\n")
-        result = search_single_reference(ref)
+        result = asyncio.run(search_single_reference(ref))
         print(json.dumps(result, indent=2))
@@ -19,50 +19,78 @@ If the essay lacks depth, makes unsupported claims, has logical fallacies, or sh
 superficial engagement with the topic, say so directly."""
 
 
-GRADING_PROMPT = """You are grading a student's essay. Below are the grading criteria and the essay text.
-
-## GRADING CRITERIA
-{criteria_text}
-
-## STUDENT ESSAY
-{essay_text}
+# Static instructions come first so that every grading request shares the same
+# prompt prefix, which Gemini can serve from its context cache. Step 4 depends on
+# whether the grader has the search_reference tool (batch requests do not).
+_GRADING_INSTRUCTIONS_HEAD = """You are grading a student's essay. The grading criteria, the essay text and \
+the search results for its references follow these instructions.
 
 ## INSTRUCTIONS
 1. Carefully read the grading criteria and the essay.
-2. For EACH criterion listed above, provide:
+2. For EACH criterion listed under GRADING CRITERIA, provide:
    - A score (out of the maximum points for that criterion, or out of 10 if no max is specified)
    - Detailed, specific feedback explaining your score. Reference exact passages from the essay.
    - Concrete suggestions for improvement.
-3. After evaluating all criteria, extract ALL bibliographic references from the essay.
-4. For each reference, use the search_reference tool to verify it exists and is correctly cited.
-5. Finally, provide an overall summary with:
+3. After evaluating all criteria, verify EACH reference listed under REFERENCE SEARCH RESULTS: \
+judge from its search results whether it exists and is correctly cited. Be skeptical — if the \
+results don't clearly confirm the reference, mark it unverified.
+"""
+
+_SEARCH_TOOL_STEP = """4. If the essay cites a reference that is missing from the search results, use the \
+search_reference tool to verify it.
+"""
+
+_NO_SEARCH_TOOL_STEP = """4. If the essay cites a reference that is missing from the search results, you cannot \
+search for it: include it in the bibliography with "verified" set to false and say in its notes \
+that it could not be checked.
+"""
+
+_GRADING_INSTRUCTIONS_TAIL = """5. Finally, provide an overall summary with:
    - Total score
    - Key strengths (be specific)
    - Key weaknesses (be specific)
    - Top 3 priority improvements the student should focus on
 
 You MUST respond with valid JSON in the following format:
-{{
+{
   "criteria_results": [
-    {{
+    {
       "criterion_name": "Name of the criterion",
       "score": <number>,
       "max_score": <number>,
       "feedback": "Detailed feedback...",
       "suggestions": "How to improve..."
-    }}
+    }
   ],
   "bibliography": [
-    {{
+    {
       "reference": "Full reference text as cited in the essay",
       "verified": true/false,
       "notes": "Verification details — does it exist? Are authors/year/title correct?"
-    }}
+    }
   ],
   "total_score": <number>,
   "max_total_score": <number>,
   "overall_feedback": "Summary of key strengths and weaknesses...",
   "priority_improvements": ["improvement 1", "improvement 2", "improvement 3"]
-}}
+}
 
 Be critical. Be thorough. Be fair. Do NOT inflate scores."""
+
+GRADING_INSTRUCTIONS = _GRADING_INSTRUCTIONS_HEAD + _SEARCH_TOOL_STEP + _GRADING_INSTRUCTIONS_TAIL
+BATCH_GRADING_INSTRUCTIONS = _GRADING_INSTRUCTIONS_HEAD + _NO_SEARCH_TOOL_STEP + _GRADING_INSTRUCTIONS_TAIL
+
+
+GRADING_CRITERIA_PROMPT = """## GRADING CRITERIA
+{criteria_text}
+"""
+
+
+GRADING_ESSAY_PROMPT = """## STUDENT ESSAY
+{essay_text}
+
+## REFERENCE SEARCH RESULTS
+The essay's bibliographic references have already been extracted and searched on Google:
+{reference_search_results}
+
+Grade the essay now, following the instructions above and responding with the JSON format they specify."""
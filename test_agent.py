@@ -0,0 +1,106 @@
+"""Offline tests for the grader's prompt budgeting and response handling.
+
+Usage:
+    pytest test_agent.py
+"""
+
+import asyncio
+
+import pytest
+from langchain_core.messages import AIMessageChunk, ToolMessage
+
+import agent
+from agent import MAX_OUTPUT_TOKENS, _estimate_output_budget, grade_essay_stream
+
+CRITERIA = (
+    "1. Thesis clarity (20 pts)\n"
+    "2. Use of evidence (20 pts)\n"
+    "3. Structure (10 pts)\n"
+)
+
+
+def test_estimate_output_budget():
+    assert _estimate_output_budget(CRITERIA, 4) == 1024 + 800 * 3 + 120 * 4
+    assert _estimate_output_budget(CRITERIA, 0) < _estimate_output_budget(CRITERIA, 10)
+    # Unknown counts fall back to the maximum
+    assert _estimate_output_budget("Grade it fairly.", 4) == MAX_OUTPUT_TOKENS
+    assert _estimate_output_budget(CRITERIA, None) == MAX_OUTPUT_TOKENS
+    # Huge rubrics are capped
+    huge = "".join(f"{i}. Criterion\n" for i in range(1, 200))
+    assert _estimate_output_budget(huge, 100) == MAX_OUTPUT_TOKENS
+
+
+class FakeModel:
+    """Stand-in for a bound Gemini model that streams canned turns."""
+
+    def __init__(self, turns):
+        self.turns = iter(turns)
+        self.budgets = []
+
+    async def astream(self, messages, generation_config):
+        self.budgets.append(generation_config["max_output_tokens"])
+        for chunk in next(self.turns):
+            yield chunk
+
+
+class FakeTool:
+    async def ainvoke(self, call):
+        return ToolMessage(content="Search results", tool_call_id=call["id"])
+
+
+@pytest.fixture
+def grader(monkeypatch):
+    """Patch the grader's models and prompt building; return a setup function."""
+    async def build_prompt(criteria_text, essay_text):
+        return "prompt", 1000
+
+    monkeypatch.setattr(agent, "_build_grading_prompt", build_prompt)
+    monkeypatch.setattr(agent, "_cache_grading_result", lambda key, result: None)
+    monkeypatch.setattr(agent, "search_reference", FakeTool())
+
+    def setup(tool_turns, answer_turns=()):
+        models = FakeModel(tool_turns), FakeModel(answer_turns)
+        monkeypatch.setattr(agent, "_get_grader_models", lambda: models)
+        return models
+
+    return setup
+
+
+def collect(agen):
+    async def run():
+        return [item async for item in agen]
+    return asyncio.run(run())
+
+
+def test_grade_essay_stream_parses_only_the_final_answer(grader):
+    tool_call = AIMessageChunk(
+        content="",
+        tool_call_chunks=[{
+            "name": "search_reference",
+            "args": '{"reference": "Smith, J. (2020)."}',
+            "id": "call-1",
+            "index": 0,
+        }],
+    )
+    grader(
+        tool_turns=[[AIMessageChunk(content="Let me check a reference. "), tool_call]],
+        answer_turns=[[AIMessageChunk(content='{"total_score": '), AIMessageChunk(content="7}")]],
+    )
+
+    *text, result = collect(grade_essay_stream(CRITERIA, "essay", force=True))
+    assert "Let me check a reference. " in text
+    assert result == {"total_score": 7}
+
+
+def test_grade_essay_stream_retries_truncated_response(grader):
+    truncated = AIMessageChunk(
+        content='{"total_sc', response_metadata={"finish_reason": "MAX_TOKENS"}
+    )
+    complete = AIMessageChunk(
+        content='{"total_score": 7}', response_metadata={"finish_reason": "STOP"}
+    )
+    tool_model, _ = grader(tool_turns=[[truncated], [complete]])
+
+    *_, result = collect(grade_essay_stream(CRITERIA, "essay", force=True))
+    assert result == {"total_score": 7}
+    assert tool_model.budgets == [1000, MAX_OUTPUT_TOKENS]
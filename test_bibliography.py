@@ -5,9 +5,25 @@ Usage:
     pytest test_bibliography.py -s --pdf path/to/other.pdf
 """
 
+import asyncio
+import json
+
 import pytest
 from pypdf import PdfReader
-from bibliography import verify_bibliography
+from bibliography import (
+    _dedupe_references,
+    _invoke_llm_json,
+    _extract_references_with_regex,
+    _slice_bibliography_section,
+    verify_bibliography,
+)
+
+APA_BIBLIOGRAPHY = (
+    "Smith, J., & Lee, K. (2020). Deep learning for\n"
+    "essay grading. Nature, 521, 436-444.\n"
+    "O'Neil, C. (2016). Weapons of math destruction. Crown.\n"
+    "Doe, A. B. (2019a). Another work on a topic. Journal of Things, 3(2), 1-10.\n"
+)
 
 
 def pytest_addoption(parser):
@@ -26,7 +42,7 @@ def essay_text(request):
 
 
 def test_bibliography_verification(essay_text):
-    results = verify_bibliography(essay_text)
+    results = asyncio.run(verify_bibliography(essay_text))
 
     assert len(results) > 0, "No references were extracted from the essay"
 
@@ -42,3 +58,74 @@ def test_bibliography_verification(essay_text):
     verified = [r for r in results if r["verified"]]
     print(f"{'='*60}")
     print(f"Summary: {len(verified)}/{len(results)} references verified")
+
+
+def test_slice_bibliography_section():
+    essay = "Intro mentioning references.\n\nBody text.\n\nReferences\n" + APA_BIBLIOGRAPHY
+    assert _slice_bibliography_section(essay) == APA_BIBLIOGRAPHY
+    assert _slice_bibliography_section("An essay without a bibliography.") is None
+    assert _slice_bibliography_section("Body.\nReferences\nSmith, J. (2020). X.") is None
+
+
+def test_extract_references_with_regex():
+    refs = _extract_references_with_regex(APA_BIBLIOGRAPHY)
+    assert refs == [
+        "Smith, J., & Lee, K. (2020). Deep learning for essay grading. Nature, 521, 436-444.",
+        "O'Neil, C. (2016). Weapons of math destruction. Crown.",
+        "Doe, A. B. (2019a). Another work on a topic. Journal of Things, 3(2), 1-10.",
+    ]
+    # Non-APA bibliographies are left to the LLM
+    assert _extract_references_with_regex("[1] J. Smith, Deep learning, 2020.\n" * 5) is None
+    assert _extract_references_with_regex("Smith, John. Deep Learning. Crown, 2020.\n") is None
+    # Entries whose start the regex misses must not be merged into their neighbour
+    for unrecognised in [
+        "World Health Organization. (2021). Global report on ageism. WHO.",
+        "van Dijk, T. A. (2008). Discourse and power. Palgrave.",
+        "Özdemir, A. (2018). A study of things. Journal of Things, 1(1), 1-9.",
+    ]:
+        section = (
+            "Smith, J. (2020). Deep learning. Nature, 521, 436-444.\n"
+            f"{unrecognised}\n"
+            "Lee, K. (2019). Other work. Crown.\n"
+        )
+        assert _extract_references_with_regex(section) is None
+
+
+def test_dedupe_references():
+    refs = [
+        "Smith, J. (2020). Deep learning. Nature.",
+        "smith, j.  (2020).  Deep  learning. Nature",
+        "Lee, K. (2019). Other work.",
+        "SMITH, J. (2020). DEEP LEARNING. NATURE;",
+    ]
+    assert list(_dedupe_references(refs).values()) == [
+        "Smith, J. (2020). Deep learning. Nature.",
+        "Lee, K. (2019). Other work.",
+    ]
+
+
+class FakeLLM:
+    """Stand-in for a Gemini client that returns canned responses."""
+
+    def __init__(self, responses, response_schema=None):
+        self.model = "fake"
+        self.response_schema = response_schema
+        self.responses = iter(responses)
+        self.calls = 0
+
+    async def ainvoke(self, prompt):
+        self.calls += 1
+        return type("Response", (), {"content": next(self.responses)})()
+
+
+def test_invoke_llm_json_caches_only_parsed_responses():
+    llm = FakeLLM(['["Smith, J. (2020).', '["Smith, J. (2020)."]'])
+    with pytest.raises(json.JSONDecodeError):
+        asyncio.run(_invoke_llm_json("truncation test", llm))
+    assert asyncio.run(_invoke_llm_json("truncation test", llm)) == ["Smith, J. (2020)."]
+    assert asyncio.run(_invoke_llm_json("truncation test", llm)) == ["Smith, J. (2020)."]
+    assert llm.calls == 2
+
+    # A client with a different schema doesn't share the cached response
+    other = FakeLLM(['{"ok": true}'], response_schema={"type": "object"})
+    assert asyncio.run(_invoke_llm_json("truncation test", other)) == {"ok": True}
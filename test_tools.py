@@ -0,0 +1,197 @@
+"""Offline tests for the search helpers in tools.py.
+
+Usage:
+    pytest test_tools.py
+"""
+
+import asyncio
+import io
+import os
+import threading
+import time
+
+import httpx
+import pytest
+from pypdf import PdfReader, PdfWriter
+
+import tools
+from tools import PDF_PARALLEL_MIN_PAGES, SingleFlight, extract_pdf_text_iter
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight(maxsize=16, ttl=60)
+    release = threading.Event()
+    calls = []
+
+    def fn(x):
+        calls.append(x)
+        release.wait(5)
+        return x * 2
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.do("k", fn, 21)))
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert calls == [21]
+    assert results == [42] * 5
+
+
+def test_single_flight_coalesces_coroutines():
+    flight = SingleFlight(maxsize=16, ttl=60)
+    calls = []
+
+    async def fn(x):
+        calls.append(x)
+        await asyncio.sleep(0.05)
+        return x * 2
+
+    async def main():
+        return await asyncio.gather(*(flight.ado("k", fn, 21) for _ in range(5)))
+
+    assert asyncio.run(main()) == [42] * 5
+    assert calls == [21]
+
+
+def test_single_flight_caches_results_until_ttl():
+    flight = SingleFlight(maxsize=16, ttl=0.2)
+    calls = []
+
+    def fn():
+        calls.append(None)
+        return len(calls)
+
+    assert flight.do("k", fn) == 1
+    assert flight.do("k", fn) == 1
+    time.sleep(0.3)
+    assert flight.do("k", fn) == 2
+
+
+def test_single_flight_propagates_errors_without_caching():
+    flight = SingleFlight(maxsize=16, ttl=60)
+    calls = []
+
+    async def fn():
+        calls.append(None)
+        await asyncio.sleep(0.05)
+        raise ValueError("boom")
+
+    async def main():
+        return await asyncio.gather(
+            *(flight.ado("k", fn) for _ in range(3)), return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(isinstance(r, ValueError) for r in results)
+
+    # Failures are not cached: the next call runs the function again
+    with pytest.raises(ValueError):
+        asyncio.run(flight.ado("k", fn))
+    assert len(calls) == 2
+
+
+def test_single_flight_owner_cancellation_lets_waiter_retry():
+    flight = SingleFlight(maxsize=16, ttl=60)
+    calls = []
+
+    async def fn():
+        calls.append(None)
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def main():
+        owner = asyncio.create_task(flight.ado("k", fn))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flight.ado("k", fn))
+        await asyncio.sleep(0)
+        owner.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        return await waiter
+
+    assert asyncio.run(main()) == "done"
+    assert len(calls) == 2
+
+
+def test_single_flight_waiter_cancellation_leaves_call_running():
+    flight = SingleFlight(maxsize=16, ttl=60)
+
+    async def fn():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def main():
+        owner = asyncio.create_task(flight.ado("k", fn))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(flight.ado("k", fn)) for _ in range(2)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()
+        return await owner, await waiters[1], waiters[0].cancelled()
+
+    assert asyncio.run(main()) == ("done", "done", True)
+
+
+def test_search_errors_do_not_leak_the_api_key(monkeypatch):
+    def handler(request):
+        assert "SECRETKEY" not in str(request.url)
+        assert request.headers["X-Goog-Api-Key"] == "SECRETKEY"
+        return httpx.Response(403, json={"error": {"message": "Forbidden"}})
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(tools, "_get_http_client", lambda: client)
+    monkeypatch.setenv("GOOGLE_SEARCH_API_KEY", "SECRETKEY")
+    monkeypatch.setenv("GOOGLE_CSE_ID", "cse")
+
+    message = tools.search_reference.invoke({"reference": "Smith, J. (2020). Leak test."})
+    assert "HTTP 403" in message
+    assert "SECRETKEY" not in message
+
+
+def test_search_deadline_starts_when_the_search_does(monkeypatch):
+    def handler(request):
+        time.sleep(0.2)
+        return httpx.Response(200, json={"items": [{"title": "T", "link": "L"}]})
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(tools, "_get_http_client", lambda: client)
+    monkeypatch.setattr(tools, "_search_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(tools, "SEARCH_DEADLINE", 0.5)
+    monkeypatch.setenv("GOOGLE_SEARCH_API_KEY", "key")
+    monkeypatch.setenv("GOOGLE_CSE_ID", "cse")
+
+    # With one slot, the last search starts after a queue-time deadline would have passed
+    async def main():
+        return await asyncio.gather(*(
+            asyncio.to_thread(tools.google_search, f"Deadline test {i}")
+            for i in range(4)
+        ))
+
+    assert all(len(items) == 1 for items in asyncio.run(main()))
+
+
+def test_extract_pdf_text_iter_parallel(monkeypatch):
+    # Repeat the sample essay until it is long enough to be split across workers
+    writer = PdfWriter()
+    sample = PdfReader("test.pdf")
+    while len(writer.pages) < PDF_PARALLEL_MIN_PAGES + 1:
+        for page in sample.pages:
+            writer.add_page(page)
+    pdf = io.BytesIO()
+    writer.write(pdf)
+
+    expected = [page.extract_text() for page in PdfReader(pdf).pages]
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+    pools = []
+    get_pool = tools._get_pdf_pool
+    monkeypatch.setattr(tools, "_get_pdf_pool", lambda: pools.append(get_pool()) or pools[-1])
+    pdf.seek(0)
+    assert list(extract_pdf_text_iter(pdf)) == [text for text in expected if text]
+    assert pools, "the parallel path was not taken"
@@ -1,19 +1,93 @@
+import asyncio
+import functools
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from concurrent.futures import Future, ProcessPoolExecutor
+import httpx
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 from pypdf import PdfReader
 from langchain_core.tools import tool
-from googlesearch import search
+
+SEARCH_RATE_LIMIT = 5  # Google searches per second, across all threads
+SEARCH_CONCURRENCY = 8  # Google searches in flight at once, across all threads
+HTTP_TIMEOUT = 10  # seconds, for each of connecting and reading
+SEARCH_ATTEMPTS = 3
+SEARCH_BACKOFF = 0.5  # seconds before the first retry, doubling for each one
+SEARCH_BACKOFF_MAX = 8
+# Longest a search may run once it holds a concurrency slot: every attempt
+# waits for a rate-limit token (with SEARCH_CONCURRENCY searches competing for
+# SEARCH_RATE_LIMIT tokens a second) and times out connecting and reading.
+# Time spent queueing for a slot does not count.
+SEARCH_DEADLINE = SEARCH_ATTEMPTS * (
+    2 * HTTP_TIMEOUT + -(-SEARCH_CONCURRENCY // SEARCH_RATE_LIMIT)
+) + sum(min(SEARCH_BACKOFF * 2**i, SEARCH_BACKOFF_MAX) for i in range(SEARCH_ATTEMPTS - 1))
+CUSTOM_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+PDF_PARALLEL_MIN_PAGES = 8  # below this, process start-up costs more than it saves
+
+
+@functools.lru_cache(maxsize=1)
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    # Forking a multi-threaded process (Streamlit, httpx, timers) can copy a
+    # held lock into the child and deadlock it, so start workers fresh
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context(method),
+    )
+
+
+def _extract_page_range(args: tuple[bytes, int, int]) -> list[str]:
+    """Extract text from pages [start, stop) of a PDF (runs in a worker process)."""
+    pdf_bytes, start, stop = args
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    return [reader.pages[i].extract_text() for i in range(start, stop)]
+
+
+def extract_pdf_text_iter(pdf_file):
+    """Yield the text of each page of a PDF file, skipping pages without text.
+
+    pypdf's extractor is pure Python and CPU-bound, so long documents are split
+    into contiguous page ranges and extracted in parallel worker processes.
+    """
+    if isinstance(pdf_file, (str, os.PathLike)):
+        with open(pdf_file, "rb") as f:
+            pdf_bytes = f.read()
+    else:
+        pdf_bytes = pdf_file.read()
+
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    n_pages = len(reader.pages)
+    workers = min(os.cpu_count() or 1, n_pages // (PDF_PARALLEL_MIN_PAGES // 2))
+
+    if n_pages < PDF_PARALLEL_MIN_PAGES or workers < 2:
+        for page in reader.pages:
+            text = page.extract_text()
+            if text:
+                yield text
+        return
+
+    step = -(-n_pages // workers)
+    ranges = [(pdf_bytes, i, min(i + step, n_pages)) for i in range(0, n_pages, step)]
+    for chunk in _get_pdf_pool().map(_extract_page_range, ranges):
+        for text in chunk:
+            if text:
+                yield text
 
 
 def extract_pdf_text(pdf_file) -> str:
     """Extract all text from an uploaded PDF file."""
-    reader = PdfReader(pdf_file)
-    pages = []
-    for page in reader.pages:
-        text = page.extract_text()
-        if text:
-            pages.append(text)
-    return "\n\n".join(pages)
+    out = io.StringIO()
+    for i, text in enumerate(extract_pdf_text_iter(pdf_file)):
+        if i:
+            out.write("\n\n")
+        out.write(text)
+    return out.getvalue()
 
 
 def extract_text_from_file(uploaded_file) -> str:
@@ -25,6 +99,213 @@ def extract_text_from_file(uploaded_file) -> str:
         return uploaded_file.read().decode("utf-8", errors="replace")
 
 
+class RateLimiter:
+    """Allow at most `rate` acquisitions per second across threads."""
+
+    def __init__(self, rate: int):
+        self._semaphore = threading.Semaphore(rate)
+
+    def acquire(self, timeout: float = None) -> bool:
+        """Wait for a token; return False if none came within `timeout` seconds."""
+        if not self._semaphore.acquire(timeout=timeout):
+            return False
+        timer = threading.Timer(1.0, self._semaphore.release)
+        timer.daemon = True
+        timer.start()
+        return True
+
+
+class _Abandoned(Exception):
+    """Set on an in-flight call whose owner was cancelled rather than failing."""
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into a single call.
+
+    The first caller for a key runs the function; callers arriving while it is
+    in flight wait on the same Future. Successful results are kept in a TTL
+    cache so later callers skip the call entirely. Exceptions are propagated to
+    every waiting caller and are not cached. If the caller running the function
+    is cancelled (or otherwise interrupted), the call is dropped and one of the
+    waiting callers runs it again instead.
+
+    Use do() from threads and ado() from coroutines; both share the same
+    in-flight calls and cache.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, Future] = {}
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def _claim(self, key: str) -> tuple[bool, Future]:
+        """Return (owner, future) for key; a cache hit gives a completed future."""
+        with self._lock:
+            if key in self._cache:
+                future = Future()
+                future.set_result(self._cache[key])
+                return False, future
+            future = self._in_flight.get(key)
+            if future is not None:
+                return False, future
+            future = self._in_flight[key] = Future()
+            # A cancelled waiter (see asyncio.wrap_future) must not cancel the
+            # shared future; a running future cannot be cancelled
+            future.set_running_or_notify_cancel()
+            return True, future
+
+    def _settle(self, key: str, future: Future, value=None, error: BaseException = None):
+        with self._lock:
+            if error is None:
+                self._cache[key] = value
+            del self._in_flight[key]
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def do(self, key: str, fn, *args):
+        while True:
+            owner, future = self._claim(key)
+            if owner:
+                break
+            try:
+                return future.result()
+            except _Abandoned:
+                continue
+
+        try:
+            value = fn(*args)
+        except Exception as e:
+            self._settle(key, future, error=e)
+            raise
+        except BaseException:
+            self._settle(key, future, error=_Abandoned())
+            raise
+        self._settle(key, future, value)
+        return value
+
+    async def ado(self, key: str, fn, *args):
+        while True:
+            owner, future = self._claim(key)
+            if owner:
+                break
+            try:
+                return await asyncio.wrap_future(future)
+            except _Abandoned:
+                continue
+
+        try:
+            value = await fn(*args)
+        except Exception as e:
+            self._settle(key, future, error=e)
+            raise
+        except BaseException:
+            self._settle(key, future, error=_Abandoned())
+            raise
+        self._settle(key, future, value)
+        return value
+
+
+def normalize_reference(reference: str) -> str:
+    """Normalize a reference string for deduplication.
+
+    Ignores case, runs of whitespace and trailing punctuation.
+    """
+    return re.sub(r"\s+", " ", reference).strip().rstrip(".,;: ").lower()
+
+
+def content_key(text: str) -> str:
+    """Return a short stable hash of a string, for use as a cache key."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+_search_limiter = RateLimiter(SEARCH_RATE_LIMIT)
+_search_slots = threading.BoundedSemaphore(SEARCH_CONCURRENCY)
+_search_flight = SingleFlight(maxsize=10_000, ttl=86400)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_http_client() -> httpx.Client:
+    return httpx.Client(timeout=HTTP_TIMEOUT)
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """Retry rate limiting, server errors, timeouts and connection failures."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+@retry(
+    stop=stop_after_attempt(SEARCH_ATTEMPTS),
+    wait=wait_exponential(multiplier=SEARCH_BACKOFF, max=SEARCH_BACKOFF_MAX),
+    retry=retry_if_exception(_is_retryable),
+    reraise=True,
+)
+def _google_search(reference: str, deadline: float) -> list[dict]:
+    api_key = os.getenv("GOOGLE_SEARCH_API_KEY") or os.getenv("GOOGLE_API_KEY")
+    cse_id = os.getenv("GOOGLE_CSE_ID")
+    if not api_key:
+        raise RuntimeError("GOOGLE_SEARCH_API_KEY is not set")
+    if not cse_id:
+        raise RuntimeError("GOOGLE_CSE_ID is not set")
+
+    if not _search_limiter.acquire(timeout=max(0, deadline - time.monotonic())):
+        raise TimeoutError("Search deadline passed waiting for the rate limiter")
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Search deadline passed")
+    # The key goes in a header: httpx errors quote the full request URL
+    response = _get_http_client().get(
+        CUSTOM_SEARCH_URL,
+        params={"cx": cse_id, "q": reference, "num": 3, "hl": "en"},
+        headers={"X-Goog-Api-Key": api_key},
+        timeout=min(HTTP_TIMEOUT, remaining),
+    )
+    response.raise_for_status()
+    return [
+        {
+            "title": item.get("title", ""),
+            "link": item.get("link", ""),
+            "snippet": item.get("snippet", ""),
+        }
+        for item in response.json().get("items", [])
+    ]
+
+
+def describe_search_error(error: Exception) -> str:
+    """Describe a failed search without quoting httpx's request URL."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"HTTP {error.response.status_code}"
+    if isinstance(error, httpx.HTTPError):
+        return type(error).__name__
+    return str(error)
+
+
+def google_search(reference: str) -> list[dict]:
+    """Search Google for a reference via the Custom Search JSON API.
+
+    Identical references (see normalize_reference) share one search, both
+    while it is in flight and for a day afterwards. At most SEARCH_CONCURRENCY
+    searches run at once; each gets SEARCH_DEADLINE seconds from when it
+    starts, however long it queued.
+
+    Returns:
+        The top results, each a dict with 'title', 'link' and 'snippet'.
+
+    Raises:
+        TimeoutError: If the search ran out of time.
+    """
+    key = content_key(normalize_reference(reference))
+    return _search_flight.do(key, _run_search, reference)
+
+
+def _run_search(reference: str) -> list[dict]:
+    with _search_slots:
+        return _google_search(reference, time.monotonic() + SEARCH_DEADLINE)
+
+
 @tool
 def search_reference(reference: str) -> str:
     """Search Google to verify whether a bibliographic reference exists and is correctly cited.
@@ -36,13 +317,7 @@ def search_reference(reference: str) -> str:
         A summary of search results indicating whether the reference appears to be real.
     """
     try:
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(lambda: list(search(reference, num_results=3, lang="en")))
-            try:
-                results = future.result(timeout=10)
-            except TimeoutError:
-                return f"Search timed out for '{reference}'. Could not verify this reference."
-        time.sleep(0.5)
+        results = google_search(reference)
 
         if not results:
             return (
@@ -51,8 +326,10 @@ def search_reference(reference: str) -> str:
             )
 
         result_text = f"Search results for: '{reference}':\n"
-        for i, url in enumerate(results, 1):
-            result_text += f"  {i}. {url}\n"
+        for i, item in enumerate(results, 1):
+            result_text += f"  {i}. {item['title']} — {item['link']}\n"
+            if item["snippet"]:
+                result_text += f"     {item['snippet']}\n"
         result_text += (
             "\nBased on these results, assess whether the reference is real "
             "and correctly cited (authors, year, title, journal)."
@@ -60,4 +337,7 @@ def search_reference(reference: str) -> str:
         return result_text
 
     except Exception as e:
-        return f"Search failed for '{reference}': {str(e)}. Could not verify this reference."
+        return (
+            f"Search failed for '{reference}': {describe_search_error(e)}. "
+            "Could not verify this reference."
+        )